@@ -3,7 +3,7 @@ Certificate Generation Models
 SQLAlchemy models for certificate management system
 """
 
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, DateTime, Text, Boolean
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, DateTime, Text, Boolean, PrimaryKeyConstraint, UniqueConstraint, Index, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -62,7 +62,7 @@ class Certificate(Base):
     serial_number = Column(String(20), unique=True, nullable=False)  # YYYY-CC-NNNN-VVVVVV
     sequential_part = Column(Integer, nullable=False)  # The NNNN part as integer
     hash_part = Column(String(6), nullable=False)  # The VVVVVV verification hash
-    issue_date = Column(Date, default=datetime.utcnow().date)
+    issue_date = Column(Date, default=lambda: datetime.utcnow().date(), server_default=func.current_date())
     issue_year = Column(Integer, nullable=False)  # Extracted year for easier querying
     status = Column(String(20), default='active')  # active, revoked, suspended
     revoked_at = Column(DateTime, nullable=True)
@@ -76,9 +76,30 @@ class Certificate(Base):
     student = relationship("Student", back_populates="certificates")
     course = relationship("Course", back_populates="certificates")
     
+    # serial_number lookups are already served by its unique index
+    __table_args__ = (
+        Index('ix_cert_course_year_seq', 'course_id', 'issue_year', 'sequential_part'),
+        Index('ix_cert_issue_year', 'issue_year'),
+    )
+    
     def __repr__(self):
         return f"<Certificate(id={self.id}, serial='{self.serial_number}', student_id={self.student_id}, course_id={self.course_id})>"
 
+class CertificateCounter(Base):
+    """Per course/year counter used to allocate certificate sequential numbers"""
+    __tablename__ = 'certificate_counters'
+    
+    course_id = Column(Integer, ForeignKey('courses.id'), nullable=False)
+    issue_year = Column(Integer, nullable=False)
+    next_seq = Column(Integer, nullable=False, default=1)  # Next sequential number to hand out
+    
+    __table_args__ = (
+        PrimaryKeyConstraint('course_id', 'issue_year'),
+    )
+    
+    def __repr__(self):
+        return f"<CertificateCounter(course_id={self.course_id}, year={self.issue_year}, next_seq={self.next_seq})>"
+
 class StudentCourse(Base):
     """Junction table for student-course enrollments"""
     __tablename__ = 'student_courses'
@@ -99,6 +120,7 @@ class StudentCourse(Base):
     
     # Unique constraint to prevent duplicate enrollments
     __table_args__ = (
+        UniqueConstraint('student_id', 'course_id', name='uq_student_course'),
         {'extend_existing': True},
     )
     
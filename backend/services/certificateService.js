@@ -287,6 +287,8 @@ class CertificateService {
       const courseResult = await this.db.query(courseQuery, [cslNumber]);
       const courseId = courseResult.rows[0].course_id;
       
+      // SHA-256 only: serials issued by utils/certificate_generator.py from its
+      // HASH_CUTOVER_YEAR on use BLAKE2b and will not verify here
       const hashInput = `${studentId}-${courseId}-${year}-${sequential}`;
       const calculatedHash = crypto.createHash('sha256').update(hashInput).digest('hex');
       const expectedHash = calculatedHash.substring(0, 6).toUpperCase();
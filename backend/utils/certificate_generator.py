@@ -4,20 +4,248 @@ Handles the generation of unique certificate serial numbers
 """
 
 import hashlib
+import io
+import re
+import threading
 from datetime import datetime
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
-from models.certificate_models import Certificate, Course
-from typing import Tuple
+from sqlalchemy import text
+from models.certificate_models import Certificate
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-def generate_serial_number(db: Session, student_id: int, course_id: int) -> Tuple[str, int, str]:
+# Pattern: YYYY-CC-NNNN-VVVVVV
+_SERIAL_RE = re.compile(r'^\d{4}-[A-Z]{2}-\d{4}-[A-F0-9]{6}$')
+_SERIAL_LENGTH = len('YYYY-CC-NNNN-VVVVVV')
+
+# Certificates issued from this year on use a BLAKE2b verification hash;
+# earlier certificates keep the truncated SHA-256 they were issued with.
+# Note: services/certificateService.js implements the same serial format with
+# SHA-256 only (Node's crypto has no BLAKE2b with a 3-byte digest), so the two
+# implementations split at the cutover: serials issued here from this year on
+# will not verify through the JS service. pgcrypto has no BLAKE2b either, so
+# verify_certificates_bulk can only recompute pre-cutover hashes in SQL.
+HASH_CUTOVER_YEAR = 2027
+
+# Statements are built once so SQLAlchemy's compiled cache and the driver's
+# prepared statements see the same objects on every call
+_STMT_COURSE_CODE = text("SELECT course_code FROM courses WHERE id = :c")
+
+_STMT_BUMP_COUNTER = text(
+    "UPDATE certificate_counters SET next_seq = next_seq + :n "
+    "WHERE course_id = :c AND issue_year = :y "
+    "RETURNING next_seq - :n"
+)
+
+_STMT_SEED_COUNTER = text(
+    "INSERT INTO certificate_counters (course_id, issue_year, next_seq) "
+    "SELECT :c, :y, COALESCE(MAX(sequential_part), 0) + 1 FROM certificates "
+    "WHERE course_id = :c AND issue_year = :y "
+    "ON CONFLICT DO NOTHING"
+)
+
+_STMT_SYNC_COUNTER = text(
+    "INSERT INTO certificate_counters (course_id, issue_year, next_seq) "
+    "VALUES (:c, :y, :n) "
+    "ON CONFLICT (course_id, issue_year) DO UPDATE "
+    "SET next_seq = GREATEST(certificate_counters.next_seq, EXCLUDED.next_seq)"
+)
+
+_STMT_VERIFY = text(
+    "SELECT status, student_id, course_id, issue_year, sequential_part "
+    "FROM certificates WHERE serial_number = :s"
+)
+
+_STMT_VERIFY_BULK = text("""
+    SELECT serial_number, status, student_id, course_id, issue_year, sequential_part,
+           CASE WHEN issue_year < :cutover THEN upper(substr(encode(digest(
+               concat_ws('-', student_id, course_id, issue_year, lpad(sequential_part::text, 4, '0')),
+               'sha256'), 'hex'), 1, 6))
+           END AS expected_hash
+    FROM certificates
+    WHERE serial_number = ANY(:serials)
+""")
+
+# GROUPING() tells per-course rows apart from per-status rows
+_STMT_STATS_BY_YEAR = text("""
+    SELECT c.course_code, c.course_name, cert.status, COUNT(*) AS count,
+           GROUPING(c.id) AS course_grouped
+    FROM certificates cert
+    JOIN courses c ON c.id = cert.course_id
+    WHERE cert.issue_year = :y
+    GROUP BY GROUPING SETS ((c.id, c.course_code, c.course_name), (cert.status))
+""")
+
+# Course codes are effectively immutable, so cache id -> code per process
+_course_code_cache: Dict[int, str] = {}
+_course_code_lock = threading.Lock()
+
+def _get_course_code(db: Session, course_id: int) -> str:
+    """
+    Look up the uppercase 2-letter code for a course, hitting the DB only once per course
+    
+    Args:
+        db: SQLAlchemy database session
+        course_id: ID of the course
+        
+    Returns:
+        Uppercase course code
+    """
+    
+    with _course_code_lock:
+        course_code = _course_code_cache.get(course_id)
+    if course_code is not None:
+        return course_code
+    
+    course_code = db.execute(_STMT_COURSE_CODE, {'c': course_id}).scalar()
+    if course_code is None:
+        raise ValueError(f"Course with ID {course_id} not found")
+    
+    course_code = course_code.upper()
+    with _course_code_lock:
+        _course_code_cache[course_id] = course_code
+    return course_code
+
+def invalidate_course_cache(course_id: int = None) -> None:
+    """
+    Drop a cached course code after the course is updated or deleted
+    
+    Args:
+        course_id: ID of the course to drop (clears the whole cache if None)
+    """
+    
+    with _course_code_lock:
+        if course_id is None:
+            _course_code_cache.clear()
+        else:
+            _course_code_cache.pop(course_id, None)
+
+def _sha256_hash(hash_input: bytes) -> str:
+    """Legacy verification hash: first 6 hex characters of SHA-256"""
+    return hashlib.sha256(hash_input).hexdigest()[:6].upper()
+
+def _blake2b_hash(hash_input: bytes) -> str:
+    """Verification hash: 3-byte BLAKE2b digest, exactly 6 hex characters"""
+    return hashlib.blake2b(hash_input, digest_size=3).hexdigest().upper()
+
+def _hash_function_for_year(year: int) -> Callable[[bytes], str]:
+    """Pick the verification hash used for certificates issued in `year`"""
+    return _sha256_hash if year < HASH_CUTOVER_YEAR else _blake2b_hash
+
+def _verification_hash(student_id: int, course_id: int, year: int, sequential: int) -> str:
+    """
+    Compute the 6-character verification hash for a certificate
+    
+    The algorithm is chosen by issue year so certificates issued before
+    HASH_CUTOVER_YEAR still verify against their original SHA-256 hash.
+    
+    Args:
+        student_id: ID of the student
+        course_id: ID of the course
+        year: Issue year
+        sequential: Sequential number (hashed zero-padded to 4 digits)
+        
+    Returns:
+        Uppercase 6-character hex hash
+    """
+    
+    # Bytes interpolation avoids the f-string + encode() round trip
+    hash_input = b"%d-%d-%d-%04d" % (student_id, course_id, year, sequential)
+    return _hash_function_for_year(year)(hash_input)
+
+def _allocate_sequential(db: Session, course_id: int, year: int, count: int = 1) -> int:
+    """
+    Atomically reserve the next `count` sequential numbers for a course and year
+    
+    The counter row is locked by the UPDATE until the surrounding transaction
+    ends, so concurrent issuers for the same course/year are serialized.
+    
+    Args:
+        db: SQLAlchemy database session
+        course_id: ID of the course
+        year: Issue year
+        count: How many consecutive numbers to reserve
+        
+    Returns:
+        The first reserved sequential number
+    """
+    
+    params = {'c': course_id, 'y': year, 'n': count}
+    
+    sequential = db.execute(_STMT_BUMP_COUNTER, params).scalar()
+    if sequential is None:
+        # First certificate for this course/year: seed the counter from any
+        # certificates issued before the counter table existed, then retry
+        db.execute(_STMT_SEED_COUNTER, params)
+        sequential = db.execute(_STMT_BUMP_COUNTER, params).scalar()
+    
+    return sequential
+
+def _issue_serial_numbers(db: Session, pairs: List[Tuple[int, int]], current_year: int) -> List[Dict[str, Any]]:
+    """
+    Reserve sequentials and build certificate rows for (student_id, course_id) pairs
+    
+    Each course's block of sequentials is reserved with one counter update.
+    Courses are visited in sorted course_id order so concurrent issuers take
+    the counter row locks in the same order and cannot deadlock.
+    
+    Args:
+        db: SQLAlchemy database session
+        pairs: List of (student_id, course_id) tuples
+        current_year: Issue year for every row
+        
+    Returns:
+        Certificate row dicts (ready for bulk_insert_mappings), in the same order as `pairs`
+    """
+    
+    by_course: Dict[int, List[int]] = {}
+    for index, (_, course_id) in enumerate(pairs):
+        by_course.setdefault(course_id, []).append(index)
+    
+    rows: List[Dict[str, Any]] = [None] * len(pairs)
+    for course_id in sorted(by_course):
+        indexes = by_course[course_id]
+        serial_prefix = f"{current_year}-{_get_course_code(db, course_id)}-"
+        first_sequential = _allocate_sequential(db, course_id, current_year, len(indexes))
+        
+        for offset, index in enumerate(indexes):
+            student_id = pairs[index][0]
+            sequential = first_sequential + offset
+            verification_hash = _verification_hash(student_id, course_id, current_year, sequential)
+            
+            rows[index] = {
+                'student_id': student_id,
+                'course_id': course_id,
+                'serial_number': f"{serial_prefix}{sequential:04d}-{verification_hash}",
+                'sequential_part': sequential,
+                'hash_part': verification_hash,
+                'issue_year': current_year
+            }
+    
+    return rows
+
+def _serial_tuples(rows: List[Dict[str, Any]]) -> List[Tuple[str, int, str]]:
+    """Reduce certificate row dicts to (serial_number, sequential_part, hash_part)"""
+    return [(row['serial_number'], row['sequential_part'], row['hash_part']) for row in rows]
+
+def generate_serial_number(
+    db: Session,
+    student_id: int,
+    course_id: int,
+    current_year: Optional[int] = None
+) -> Tuple[str, int, str]:
     """
     Generate a unique certificate serial number in format: YYYY-CC-NNNN-VVVVVV
     
+    Does not commit. Callers issuing several certificates must use
+    generate_and_issue_many (or generate_serial_numbers_bulk) rather than
+    calling this in a loop with a commit per certificate.
+    
     Args:
         db: SQLAlchemy database session
         student_id: ID of the student
         course_id: ID of the course
+        current_year: Issue year (defaults to the current year); callers
+                      batching through a service layer pass a cached value
         
     Returns:
         Tuple containing (serial_number, sequential_part, hash_part)
@@ -26,42 +254,143 @@ def generate_serial_number(db: Session, student_id: int, course_id: int) -> Tupl
         ('2024-WD-0001-A1B2C3', 1, 'A1B2C3')
     """
     
-    # Get current year
-    current_year = datetime.now().year
+    if current_year is None:
+        current_year = datetime.now().year
     
-    # Get the course to retrieve the 2-letter code
-    course = db.query(Course).filter(Course.id == course_id).first()
-    if not course:
-        raise ValueError(f"Course with ID {course_id} not found")
+    rows = _issue_serial_numbers(db, [(student_id, course_id)], current_year)
+    return _serial_tuples(rows)[0]
+
+def generate_serial_numbers_bulk(
+    db: Session,
+    pairs: List[Tuple[int, int]],
+    current_year: Optional[int] = None
+) -> List[Tuple[str, int, str]]:
+    """
+    Issue certificates for many (student_id, course_id) pairs and commit
     
-    course_code = course.course_code.upper()
+    All rows are written with a single bulk insert, then committed.
     
-    # Find the maximum sequential number for this course and year
-    max_sequential = db.query(func.max(Certificate.sequential_part)).filter(
-        and_(
-            Certificate.course_id == course_id,
-            Certificate.issue_year == current_year
-        )
-    ).scalar()
+    Args:
+        db: SQLAlchemy database session
+        pairs: List of (student_id, course_id) tuples
+        current_year: Issue year (defaults to the current year, computed once per batch)
+        
+    Returns:
+        List of (serial_number, sequential_part, hash_part) in the same order as `pairs`
+    """
     
-    # Calculate next sequential number (starts from 1 each year)
-    next_sequential = (max_sequential or 0) + 1
+    if current_year is None:
+        current_year = datetime.now().year
     
-    # Format sequential number with zero padding (4 digits)
-    sequential_str = f"{next_sequential:04d}"
+    rows = _issue_serial_numbers(db, pairs, current_year)
+    db.bulk_insert_mappings(Certificate, rows)
+    db.commit()
     
-    # Create verification hash
-    hash_input = f"{student_id}-{course_id}-{current_year}-{sequential_str}"
-    hash_object = hashlib.sha256(hash_input.encode())
-    hash_hex = hash_object.hexdigest()
+    return _serial_tuples(rows)
+
+def generate_and_issue_many(
+    db: Session,
+    pairs: List[Tuple[int, int]],
+    current_year: Optional[int] = None
+) -> List[Tuple[str, int, str]]:
+    """
+    Issue certificates for many pairs as one unit of work with at most one commit
+    
+    If the session already has a transaction open, the batch runs in a
+    savepoint inside it and the caller's commit persists it; otherwise the
+    batch runs in its own transaction, committed once at the end.
+    
+    Args:
+        db: SQLAlchemy database session
+        pairs: List of (student_id, course_id) tuples
+        current_year: Issue year (defaults to the current year, computed once per batch)
+        
+    Returns:
+        List of (serial_number, sequential_part, hash_part) in the same order as `pairs`
+    """
+    
+    if current_year is None:
+        current_year = datetime.now().year
+    
+    with db.begin_nested() if db.in_transaction() else db.begin():
+        rows = _issue_serial_numbers(db, pairs, current_year)
+        db.bulk_insert_mappings(Certificate, rows)
+    
+    return _serial_tuples(rows)
+
+# Batches of this size or smaller are not worth the COPY setup cost
+COPY_THRESHOLD = 100
+
+_COPY_COLUMNS = (
+    'student_id', 'course_id', 'serial_number', 'sequential_part',
+    'hash_part', 'issue_date', 'issue_year', 'status', 'created_at', 'updated_at'
+)
+
+# COPY text format escapes, so stray tabs/newlines in legacy data cannot shift columns
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_value(value: Any) -> str:
+    """Render one value in PostgreSQL COPY text format"""
+    if value is None:
+        return '\\N'
+    return str(value).translate(_COPY_ESCAPES)
+
+def bulk_copy_certificates(session: Session, rows: List[Dict[str, Any]]) -> int:
+    """
+    Load pre-built certificate rows (e.g. a legacy archive) using PostgreSQL COPY
+    
+    Batches of up to COPY_THRESHOLD rows fall back to bulk_insert_mappings.
+    The COPY path fills in the same Python-side defaults (status, issue_date,
+    created_at, updated_at) that the ORM would, so both paths store identical rows. Either way
+    the per course/year counters are moved past the loaded sequentials so that
+    newly issued certificates do not collide with the imported ones.
+    
+    Args:
+        session: SQLAlchemy database session
+        rows: Dicts keyed by student_id, course_id, serial_number, sequential_part,
+              hash_part and issue_year; status, issue_date, created_at and
+              updated_at are optional
+        
+    Returns:
+        Number of rows loaded
+    """
+    
+    if not rows:
+        return 0
+    
+    if len(rows) <= COPY_THRESHOLD:
+        session.bulk_insert_mappings(Certificate, rows)
+    else:
+        # Fill the ORM's Python-side defaults per row, since COPY bypasses them
+        now = datetime.utcnow()
+        defaults = {'status': 'active', 'issue_date': now.date(), 'created_at': now, 'updated_at': now}
+        
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(
+                _copy_value(row[column] if row.get(column) is not None else defaults.get(column))
+                for column in _COPY_COLUMNS
+            ))
+            buf.write('\n')
+        buf.seek(0)
+        
+        raw_conn = session.connection().connection
+        with raw_conn.cursor() as cur:
+            cur.copy_from(buf, 'certificates', columns=_COPY_COLUMNS, sep='\t')
     
-    # Take first 6 characters and convert to uppercase
-    verification_hash = hash_hex[:6].upper()
+    # Highest loaded sequential per course/year, so the counters can skip past it
+    highest: Dict[Tuple[int, int], int] = {}
+    for row in rows:
+        key = (row['course_id'], row['issue_year'])
+        highest[key] = max(highest.get(key, 0), row['sequential_part'])
     
-    # Construct the full serial number
-    serial_number = f"{current_year}-{course_code}-{sequential_str}-{verification_hash}"
+    session.execute(_STMT_SYNC_COUNTER, [
+        {'c': course_id, 'y': year, 'n': sequential + 1}
+        for (course_id, year), sequential in highest.items()
+    ])
     
-    return serial_number, next_sequential, verification_hash
+    session.commit()
+    return len(rows)
 
 def validate_serial_number(serial_number: str) -> bool:
     """
@@ -73,61 +402,54 @@ def validate_serial_number(serial_number: str) -> bool:
     Returns:
         True if valid format, False otherwise
     """
-    import re
     
-    # Pattern: YYYY-CC-NNNN-VVVVVV
-    pattern = r'^\d{4}-[A-Z]{2}-\d{4}-[A-F0-9]{6}$'
-    return bool(re.match(pattern, serial_number))
+    # Cheap length check rejects most malformed input before the regex runs
+    return len(serial_number) == _SERIAL_LENGTH and _SERIAL_RE.match(serial_number) is not None
 
-def verify_certificate_authenticity(db: Session, serial_number: str) -> dict:
+def _verification_result(serial_number: str, row: Any, expected_hash: Optional[str] = None) -> dict:
     """
-    Verify if a certificate is authentic by checking the hash
+    Build the verification result for a well-formed serial number
     
     Args:
-        db: SQLAlchemy database session
-        serial_number: Certificate serial number to verify
+        serial_number: Certificate serial number being verified
+        row: Mapping with status, student_id, course_id, issue_year and
+             sequential_part, or None if no such certificate exists
+        expected_hash: Hash already computed by the database, if any;
+                       otherwise it is recomputed with _verification_hash
         
     Returns:
         Dictionary with verification results
     """
     
-    if not validate_serial_number(serial_number):
-        return {
-            'is_valid': False,
-            'reason': 'Invalid serial number format',
-            'certificate': None
-        }
-    
-    # Find certificate in database
-    certificate = db.query(Certificate).filter(
-        Certificate.serial_number == serial_number
-    ).first()
-    
-    if not certificate:
+    if row is None:
         return {
             'is_valid': False,
             'reason': 'Certificate not found in database',
             'certificate': None
         }
     
+    certificate = {
+        'serial_number': serial_number,
+        'status': row['status'],
+        'student_id': row['student_id'],
+        'course_id': row['course_id']
+    }
+    
     # Check if certificate is revoked or suspended
-    if certificate.status != 'active':
+    if row['status'] != 'active':
         return {
             'is_valid': False,
-            'reason': f'Certificate status is {certificate.status}',
+            'reason': f"Certificate status is {row['status']}",
             'certificate': certificate
         }
     
-    # Verify the hash part
-    parts = serial_number.split('-')
-    year, course_code, sequential, provided_hash = parts
-    
     # Regenerate hash to verify authenticity
-    hash_input = f"{certificate.student_id}-{certificate.course_id}-{year}-{sequential}"
-    hash_object = hashlib.sha256(hash_input.encode())
-    expected_hash = hash_object.hexdigest()[:6].upper()
+    if expected_hash is None:
+        expected_hash = _verification_hash(
+            row['student_id'], row['course_id'], row['issue_year'], row['sequential_part']
+        )
     
-    if provided_hash != expected_hash:
+    if serial_number[-6:] != expected_hash:
         return {
             'is_valid': False,
             'reason': 'Hash verification failed - certificate may be forged',
@@ -140,6 +462,78 @@ def verify_certificate_authenticity(db: Session, serial_number: str) -> dict:
         'certificate': certificate
     }
 
+def verify_certificate_authenticity(db: Session, serial_number: str) -> dict:
+    """
+    Verify if a certificate is authentic by checking the hash
+    
+    Applies the same checks as verify_certificates_bulk, with the hash
+    recomputed in Python, so no database extension is required.
+    
+    Args:
+        db: SQLAlchemy database session
+        serial_number: Certificate serial number to verify
+        
+    Returns:
+        Dictionary with verification results
+    """
+    
+    if not validate_serial_number(serial_number):
+        return {
+            'is_valid': False,
+            'reason': 'Invalid serial number format',
+            'certificate': None
+        }
+    
+    # Fetch only the columns the checks need; no Certificate instance is hydrated
+    row = db.execute(_STMT_VERIFY, {'s': serial_number}).mappings().first()
+    return _verification_result(serial_number, row)
+
+def verify_certificates_bulk(db: Session, serial_numbers: List[str]) -> List[dict]:
+    """
+    Verify many certificates (e.g. a transcript page) in one round trip
+    
+    The verification hash of each certificate is recomputed from its stored
+    student, course, year and sequential number. Only legacy SHA-256
+    certificates (issue_year < HASH_CUTOVER_YEAR) are rehashed by PostgreSQL
+    via pgcrypto's digest(). pgcrypto has no BLAKE2b, so every certificate
+    issued from HASH_CUTOVER_YEAR on is rehashed in Python, one hash per row,
+    exactly as in verify_certificate_authenticity; the SQL-side recomputation
+    is a saving for older certificates only. Requires the pgcrypto extension.
+    
+    Args:
+        db: SQLAlchemy database session
+        serial_numbers: Certificate serial numbers to verify
+        
+    Returns:
+        List of verification result dicts, in the same order as `serial_numbers`
+    """
+    
+    well_formed = {serial for serial in serial_numbers if validate_serial_number(serial)}
+    
+    found = {}
+    if well_formed:
+        rows = db.execute(
+            _STMT_VERIFY_BULK, {'cutover': HASH_CUTOVER_YEAR, 'serials': list(well_formed)}
+        ).mappings()
+        found = {row['serial_number']: row for row in rows}
+    
+    results = []
+    for serial_number in serial_numbers:
+        if serial_number not in well_formed:
+            results.append({
+                'is_valid': False,
+                'reason': 'Invalid serial number format',
+                'certificate': None
+            })
+            continue
+        
+        row = found.get(serial_number)
+        results.append(_verification_result(
+            serial_number, row, row['expected_hash'] if row is not None else None
+        ))
+    
+    return results
+
 def get_certificate_stats_by_year(db: Session, year: int = None) -> dict:
     """
     Get statistics about certificates issued in a specific year
@@ -155,48 +549,27 @@ def get_certificate_stats_by_year(db: Session, year: int = None) -> dict:
     if year is None:
         year = datetime.now().year
     
-    # Total certificates issued this year
-    total_certificates = db.query(Certificate).filter(
-        Certificate.issue_year == year
-    ).count()
-    
-    # Certificates by course
-    course_stats = db.query(
-        Course.course_code,
-        Course.course_name,
-        func.count(Certificate.id).label('count')
-    ).join(
-        Certificate, Course.id == Certificate.course_id
-    ).filter(
-        Certificate.issue_year == year
-    ).group_by(
-        Course.id, Course.course_code, Course.course_name
-    ).all()
-    
-    # Active vs revoked certificates
-    status_stats = db.query(
-        Certificate.status,
-        func.count(Certificate.id).label('count')
-    ).filter(
-        Certificate.issue_year == year
-    ).group_by(
-        Certificate.status
-    ).all()
+    # Per-course and per-status counts in one round trip
+    rows = db.execute(_STMT_STATS_BY_YEAR, {'y': year}).mappings()
+    
+    by_course = []
+    by_status = []
+    for row in rows:
+        if row['course_grouped']:
+            by_status.append({'status': row['status'], 'count': row['count']})
+        else:
+            by_course.append({
+                'course_code': row['course_code'],
+                'course_name': row['course_name'],
+                'count': row['count']
+            })
+    
+    # Every certificate has exactly one status, so the status counts sum to the total
+    total_certificates = sum(stat['count'] for stat in by_status)
     
     return {
         'year': year,
         'total_certificates': total_certificates,
-        'by_course': [
-            {
-                'course_code': stat[0],
-                'course_name': stat[1],
-                'count': stat[2]
-            } for stat in course_stats
-        ],
-        'by_status': [
-            {
-                'status': stat[0],
-                'count': stat[1]
-            } for stat in status_stats
-        ]
+        'by_course': by_course,
+        'by_status': by_status
     }